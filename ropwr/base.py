@@ -6,12 +6,14 @@ Robust piecewise regression.
 # Copyright (C) 2020
 
 import numbers
+import os
+
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
 from sklearn.base import BaseEstimator
 from sklearn.utils import check_array
-from sklearn.utils import check_consistent_length
 from sklearn.exceptions import NotFittedError
 
 from .direct import lsq_direct
@@ -20,11 +22,34 @@ from .cvx_socp import socp
 from .cvx_socp import socp_separated
 from .cvx_qp import qp
 from .cvx_qp import qp_separated
+from .kernels import NUMBA_AVAILABLE
+from .matrices import sparse_matrix_A
+
+if NUMBA_AVAILABLE:
+    from .kernels import predict_kernel
+
+
+# Solver for each method and its arguments after (x, y, splits). Arguments
+# are estimator parameters or the bounds lb and ub.
+_METHODS = {
+    "lsq_direct": (lsq_direct, ("degree",)),
+    "lsq_direct_separated": (lsq_direct_separated, ("degree",)),
+    "socp": (socp, ("degree", "continuous", "lb", "ub", "objective",
+                    "monotonic_trend", "h_epsilon", "quantile",
+                    "regularization", "reg_l1", "reg_l2", "verbose")),
+    "socp_separated": (socp_separated, ("degree", "lb", "ub", "objective",
+                                        "monotonic_trend", "h_epsilon",
+                                        "quantile", "verbose")),
+    "qp": (qp, ("degree", "continuous", "lb", "ub", "monotonic_trend",
+                "verbose")),
+    "qp_separated": (qp_separated, ("degree", "lb", "ub", "monotonic_trend",
+                                    "verbose"))
+}
 
 
 def _check_parameters(objective, regularization, degree, continuous,
                       monotonic_trend, solver, h_epsilon, quantile, reg_l1,
-                      reg_l2, verbose):
+                      reg_l2, verbose, dtype, n_jobs):
 
     if objective not in ("l1", "l2", "huber", "quantile"):
         raise ValueError('Invalid value for objective. Allowed string '
@@ -77,6 +102,19 @@ def _check_parameters(objective, regularization, degree, continuous,
     if not isinstance(verbose, bool):
         raise TypeError("verbose must be a boolean; got {}.".format(verbose))
 
+    _check_dtype(dtype)
+
+    if (not isinstance(n_jobs, numbers.Integral) or isinstance(n_jobs, bool)
+            or not (n_jobs >= 1 or n_jobs == -1)):
+        raise ValueError("n_jobs must be a positive integer or -1; got {}."
+                         .format(n_jobs))
+
+
+def _check_dtype(dtype):
+    if dtype not in ("auto", "float32", "float64"):
+        raise ValueError('Invalid value for dtype. Allowed string values are '
+                         '"auto", "float32" and "float64".')
+
 
 def _choose_method(objective, degree, continuous, monotonic_trend, solver,
                    bounded, regularization):
@@ -136,6 +174,29 @@ def _choose_method(objective, degree, continuous, monotonic_trend, solver,
             return "socp_separated"
 
 
+def _solve_separated_parallel(solver, x, y, splits, args, n_jobs):
+    # Bins of sorted data are contiguous slices. Solve each bin as a problem
+    # without splits in a separate thread.
+    bounds = np.searchsorted(x, splits, side='left')
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(x)]))
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    def solve_bin(i):
+        s, e = starts[i], ends[i]
+        return solver(x[s:e], y[s:e], [], *args)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(solve_bin, range(len(starts))))
+
+    c = np.vstack([ci for ci, _ in results])
+    infos = [info for _, infos in results for info in infos]
+
+    return c, infos
+
+
 def _check_bounds(lb, ub):
     if lb is not None:
         if not isinstance(lb, numbers.Number):
@@ -152,6 +213,35 @@ def _check_bounds(lb, ub):
             raise ValueError("lb must be <= ub.")
 
 
+def _check_input(a, dtype=np.float64):
+    # Fast path for 1-D float arrays: a single reduction detects NaN or inf.
+    # Fall back to a full scan in case of overflow in the summation.
+    if isinstance(a, np.ndarray) and a.ndim == 1 and a.dtype.kind == "f":
+        a = np.ascontiguousarray(a, dtype=dtype)
+
+        if not a.size:
+            raise ValueError("Found array with 0 sample(s) (shape={}) while a "
+                             "minimum of 1 is required.".format(a.shape))
+
+        if not np.isfinite(a.sum()) and not np.isfinite(a).all():
+            raise ValueError("Input contains NaN or infinity.")
+
+        return a
+
+    a = check_array(a, ensure_2d=False, dtype=dtype, force_all_finite=True)
+
+    if a.ndim != 1:
+        raise ValueError("Input must be a 1-D array; got shape {}."
+                         .format(a.shape))
+
+    return a
+
+
+def _validation_key(*values):
+    # Include types so that, e.g., 1 and True do not share a key.
+    return tuple((type(value), value) for value in values)
+
+
 def _check_splits(splits, monotonic_trend):
     if not isinstance(splits, (list, np.ndarray)):
         raise TypeError("splits must be a list or numpy.ndarray.")
@@ -166,11 +256,10 @@ def _check_splits(splits, monotonic_trend):
         user_splits = check_array(splits, ensure_2d=False,
                                   force_all_finite=True)
 
-        if len(set(user_splits)) != len(user_splits):
-            raise ValueError("splits are not unique.")
+        user_splits = np.sort(user_splits)
 
-        sorted_idx = np.argsort(user_splits)
-        user_splits = user_splits[sorted_idx]
+        if np.any(user_splits[1:] == user_splits[:-1]):
+            raise ValueError("splits are not unique.")
 
         return user_splits
 
@@ -231,6 +320,17 @@ class RobustPWRegression(BaseEstimator):
     verbose : bool (default=False)
         Enable verbose output.
 
+    dtype : str, optional (default="auto")
+        The floating point type used in predict. Supported types are
+        "float32", "float64" and "auto". If "auto", float32 inputs are
+        predicted in single precision and any other input in double precision.
+        Fitting is always performed in double precision.
+
+    n_jobs : int (default=1)
+        Number of threads used to solve the problem of each bin when the
+        piecewise regression is discontinuous and bins are independent. -1
+        means using all processors.
+
     Attributes
     ----------
     coef_ : numpy.ndarray of shape (n_splits + 1, degree + 1)
@@ -239,7 +339,7 @@ class RobustPWRegression(BaseEstimator):
     def __init__(self, objective="l2", degree=1, continuous=True,
                  monotonic_trend=None, solver="auto", h_epsilon=1.35,
                  quantile=0.5, regularization=None, reg_l1=1.0, reg_l2=1.0,
-                 verbose=False):
+                 verbose=False, dtype="auto", n_jobs=1):
 
         self.objective = objective
         self.degree = degree
@@ -252,11 +352,29 @@ class RobustPWRegression(BaseEstimator):
         self.reg_l1 = reg_l1
         self.reg_l2 = reg_l2
         self.verbose = verbose
+        self.dtype = dtype
+        self.n_jobs = n_jobs
 
         self.coef_ = None
 
+        self._method = None
+        self._method_key = None
+
+        self._sort_cache = (None, None)
+
+        self._params_validated_key = None
+        self._bounds_validated_key = None
+
         self._is_fitted = False
 
+    def __getstate__(self):
+        state = super().__getstate__().copy()
+
+        # Do not persist the sort permutation of the training data
+        state["_sort_cache"] = (None, None)
+
+        return state
+
     def fit(self, x, y, splits, lb=None, ub=None):
         """Fit the piecewise regression according to the given training data.
 
@@ -279,63 +397,7 @@ class RobustPWRegression(BaseEstimator):
         self : object
             Fitted piecewise regression.
         """
-        _check_parameters(**self.get_params())
-
-        # Check inputs x and y
-        x = check_array(x, ensure_2d=False, force_all_finite=True)
-        y = check_array(y, ensure_2d=False, force_all_finite=True)
-        check_consistent_length(x, y)
-
-        idx = np.argsort(x)
-        xs = x[idx]
-        ys = y[idx]
-
-        # Check user splits
-        _check_splits(splits, self.monotonic_trend)
-
-        # Check bounds
-        bounded = (lb is not None or ub is not None)
-
-        if bounded:
-            _check_bounds(lb, ub)
-
-        # Choose the most appropriate method/solver given the parameters
-        _method = _choose_method(self.objective, self.degree, self.continuous,
-                                 self.monotonic_trend, self.solver, bounded,
-                                 self.regularization)
-
-        if _method == "lsq_direct":
-            c, info = lsq_direct(xs, ys, splits, self.degree)
-        elif _method == "lsq_direct_separated":
-            c, info = lsq_direct_separated(xs, ys, splits, self.degree)
-        elif _method == "socp":
-            c, info = socp(xs, ys, splits, self.degree, self.continuous, lb,
-                           ub, self.objective, self.monotonic_trend,
-                           self.h_epsilon, self.quantile, self.regularization,
-                           self.reg_l1, self.reg_l2, self.verbose)
-        elif _method == "socp_separated":
-            c, info = socp_separated(xs, ys, splits, self.degree, lb, ub,
-                                     self.objective, self.monotonic_trend,
-                                     self.h_epsilon, self.quantile,
-                                     self.verbose)
-        elif _method == "qp":
-            c, info = qp(xs, ys, splits, self.degree, self.continuous, lb, ub,
-                         self.monotonic_trend, self.verbose)
-        elif _method == "qp_separated":
-            c, info = qp_separated(xs, ys, splits, self.degree, lb, ub,
-                                   self.monotonic_trend, self.verbose)
-
-        self.coef_ = c
-
-        if self.continuous or self.degree == 0:
-            self._status = info["status"]
-            self._stats = info["stats"]
-        else:
-            self._status = [_info["status"] for _info in info]
-            self._stats = [_info["stats"] for _info in info]
-
-        self._splits = splits
-        self._is_fitted = True
+        self._fit(x, y, splits, lb, ub)
 
         return self
 
@@ -366,7 +428,14 @@ class RobustPWRegression(BaseEstimator):
         p : numpy array, shape = (n_samples,)
             Predicted array.
         """
-        return self.fit(x, y, splits, lb, ub).predict(x, lb, ub)
+        # Keep the input dtype, since fit converts x to float64
+        x_dtype = getattr(x, "dtype", None)
+
+        # Parameters, x and bounds are validated in fit
+        x = self._fit(x, y, splits, lb, ub)
+        dtype = self._predict_dtype(x_dtype)
+
+        return self._predict(x.astype(dtype, copy=False), lb, ub)
 
     def predict(self, x, lb=None, ub=None):
         """Predict using the piecewise regression.
@@ -387,27 +456,214 @@ class RobustPWRegression(BaseEstimator):
         p : numpy array, shape = (n_samples,)
             Predicted array.
         """
+        # Inline fitted check to avoid a method call on every prediction
+        if not self._is_fitted:
+            self._check_is_fitted()
+
+        x = _check_input(x, self._predict_dtype(getattr(x, "dtype", None)))
+
+        if lb is not None or ub is not None:
+            self._check_bounds(lb, ub)
+
+        return self._predict(x, lb, ub)
+
+    def basis_matrix(self, x):
+        """Sparse matrix of the piecewise polynomial basis evaluated at x.
+
+        Each row contains the powers of x in the block of columns of its bin,
+        so ``basis_matrix(x) @ coef_.ravel()`` is equal to ``predict(x)``.
+        The matrix only depends on the splits and degree, and can be reused
+        across predictions on the same x.
+
+        Parameters
+        ----------
+        x : array-like, shape = (n_samples,)
+            Input vector, where n_samples is the number of samples.
+
+        Returns
+        -------
+        B : scipy.sparse.csr_matrix, shape = (n_samples, n_bins * (degree + 1))
+            Basis matrix.
+        """
         self._check_is_fitted()
 
-        bounded = (lb is not None or ub is not None)
+        x = _check_input(x)
 
-        if bounded:
-            _check_bounds(lb, ub)
+        return sparse_matrix_A(x, self._splits, self.coef_.shape[1])
+
+    def _fit(self, x, y, splits, lb, ub):
+        # Skip validation if parameters have not changed since last fit
+        params_key = _validation_key(
+            self.objective, self.regularization, self.degree, self.continuous,
+            self.monotonic_trend, self.solver, self.h_epsilon, self.quantile,
+            self.reg_l1, self.reg_l2, self.verbose, self.dtype, self.n_jobs)
 
-        n_bins = len(self._splits) + 1
-        indices = np.digitize(x, self._splits, right=False)
+        if params_key != self._params_validated_key:
+            _check_parameters(**self.get_params())
+            self._params_validated_key = params_key
 
-        pred = np.zeros(x.shape)
-        for i in range(n_bins):
-            mask = (indices == i)
-            pred[mask] = np.polyval(self.coef_[i, :][::-1], x[mask])
+        # Check inputs x and y
+        x_id = id(x)
+        x = _check_input(x)
+        y = _check_input(y)
+
+        if x.shape[0] != y.shape[0]:
+            raise ValueError("x and y have inconsistent numbers of samples: "
+                             "{} != {}.".format(x.shape[0], y.shape[0]))
+
+        # Sort data by x. Skip if x is already sorted, e.g., time series.
+        if x.size > 1 and (x[1:] >= x[:-1]).all():
+            xs = x
+            ys = y
+        else:
+            xs = np.empty_like(x)
+            ys = np.empty_like(y)
+
+            # Reuse the sort permutation from the previous fit on the same x,
+            # e.g., during hyperparameter search, provided it still sorts x.
+            sort_key = (x_id, x.shape)
+            cached_key, idx = self._sort_cache
+
+            if cached_key == sort_key:
+                np.take(x, idx, out=xs)
+                if not (xs[1:] >= xs[:-1]).all():
+                    idx = None
+            else:
+                idx = None
+
+            if idx is None:
+                idx = np.argsort(x, kind="quicksort")
+                np.take(x, idx, out=xs)
+                self._sort_cache = (sort_key, idx)
 
+            np.take(y, idx, out=ys)
+
+        # Check user splits
+        splits = _check_splits(splits, self.monotonic_trend)
+
+        # Check bounds
         bounded = (lb is not None or ub is not None)
+
         if bounded:
-            pred = np.clip(pred, lb, ub)
+            self._check_bounds(lb, ub)
+
+        # Choose the most appropriate method/solver given the parameters.
+        # Reuse the previous choice if the relevant parameters are unchanged.
+        method_key = (self.objective, self.degree, self.continuous,
+                      self.monotonic_trend, self.solver, bounded,
+                      self.regularization)
+
+        if method_key != self._method_key:
+            self._method = _choose_method(*method_key)
+            self._method_key = method_key
+
+        _method = self._method
+
+        solver, arg_names = _METHODS[_method]
+        options = dict(vars(self), lb=lb, ub=ub)
+        args = [options[name] for name in arg_names]
+
+        if (_method.endswith("_separated") and self.n_jobs != 1
+                and len(splits)):
+            c, info = _solve_separated_parallel(solver, xs, ys, splits, args,
+                                                self.n_jobs)
+        else:
+            c, info = solver(xs, ys, splits, *args)
+
+        self.coef_ = c
+
+        # Coefficients in Horner order (highest degree first) for predict
+        self._coef_horner = np.ascontiguousarray(c[:, ::-1])
+
+        # Same coefficients with shape (degree + 1, n_bins), so that the
+        # gather of each power is a contiguous vector of length n_samples
+        self._coef_soa = np.ascontiguousarray(self._coef_horner.T)
+
+        # Single precision copies for float32 predictions
+        self._coef_horner_f32 = self._coef_horner.astype(np.float32)
+        self._coef_soa_f32 = self._coef_soa.astype(np.float32)
+
+        if not _method.endswith("_separated"):
+            self._status = info["status"]
+            self._stats = info["stats"]
+        else:
+            self._status = [_info["status"] for _info in info]
+            self._stats = [_info["stats"] for _info in info]
+
+        self._splits = np.ascontiguousarray(splits, dtype=x.dtype)
+        self._splits_f32 = self._splits.astype(np.float32)
+        self._is_fitted = True
+
+        return x
+
+    def _predict(self, x, lb, ub):
+        if x.dtype == np.float32:
+            splits = self._splits_f32
+            coef_horner = self._coef_horner_f32
+            coef_soa = self._coef_soa_f32
+        else:
+            splits = self._splits
+            coef_horner = self._coef_horner
+            coef_soa = self._coef_soa
+
+        if NUMBA_AVAILABLE:
+            # Clipping is fused into the kernel
+            pred = np.empty(x.shape, dtype=x.dtype)
+            kernel = predict_kernel(coef_horner.shape[1])
+            kernel(x, splits, coef_horner, -np.inf if lb is None else lb,
+                   np.inf if ub is None else ub, pred)
+
+            return pred
+
+        if not splits.size:
+            # Single polynomial, no bin lookup
+            pred = np.polyval(coef_horner[0], x)
+        elif coef_soa.shape[0] == 1:
+            # Piecewise constant, a single gather
+            pred = coef_soa[0, splits.searchsorted(x, 'right')]
+        else:
+            pred = self._predict_horner(x, splits, coef_soa)
+
+        if lb is not None or ub is not None:
+            np.clip(pred, lb, ub, out=pred)
+
+        return pred
+
+    def _predict_horner(self, x, splits, coef_soa):
+        indices = splits.searchsorted(x, side='right')
+
+        # Evaluate all bins at once using Horner's method. Each sample
+        # gathers the coefficients of its bin, one power at a time. Each step
+        # is an independent pass over all samples, so evaluating the powers
+        # of x and summing them does not shorten any dependency chain; it
+        # only adds memory traffic. Measured for degrees 3 and 5 with
+        # n_samples = 1e4 and 1e6, it was 40-50% slower.
+        pred = coef_soa[0, indices]
+        for k in range(1, coef_soa.shape[0]):
+            pred *= x
+            pred += coef_soa[k, indices]
 
         return pred
 
+    def _predict_dtype(self, x_dtype):
+        # dtype can be changed after fit with set_params
+        _check_dtype(self.dtype)
+
+        if self.dtype == "auto":
+            if x_dtype == np.float32:
+                return np.float32
+            else:
+                return np.float64
+        else:
+            return np.dtype(self.dtype).type
+
+    def _check_bounds(self, lb, ub):
+        bounds_key = _validation_key(lb, ub)
+
+        if bounds_key != self._bounds_validated_key:
+            _check_bounds(lb, ub)
+            self._bounds_validated_key = bounds_key
+
     def _check_is_fitted(self):
         if not self._is_fitted:
             raise NotFittedError("This {} instance is not fitted yet. Call "
@@ -0,0 +1,70 @@
+"""
+Compiled kernels for piecewise polynomial evaluation. Numba is optional.
+"""
+
+# Guillermo Navas-Palencia <g.navas.palencia@gmail.com>
+# Copyright (C) 2020
+
+from functools import lru_cache
+
+try:
+    from numba import njit
+    from numba import prange
+except ImportError:
+    njit = None
+
+
+NUMBA_AVAILABLE = njit is not None
+
+# Maximum number of splits for a linear branchless bin search
+_LINEAR_SEARCH_MAX_SPLITS = 16
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _bin_index(xi, splits):
+        # Equivalent to np.searchsorted(splits, xi, side='right')
+        n_splits = splits.size
+
+        if n_splits <= _LINEAR_SEARCH_MAX_SPLITS:
+            b = 0
+            for s in range(n_splits):
+                b += xi >= splits[s]
+            return b
+
+        lo = 0
+        hi = n_splits
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if xi >= splits[mid]:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # All fast-math flags except "nnan" and "ninf", since infinite bounds
+    # are used to disable clipping.
+    _FASTMATH_FLAGS = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+    @lru_cache(maxsize=None)
+    def predict_kernel(order):
+        # Kernel specialized for a given polynomial order. The order is a
+        # compile-time constant, so the Horner loop is fully unrolled.
+        @njit(parallel=True, fastmath=_FASTMATH_FLAGS, cache=True)
+        def _predict_kernel(x, splits, coef_horner, lb, ub, out):
+            for i in prange(x.size):
+                xi = x[i]
+                b = _bin_index(xi, splits)
+
+                acc = coef_horner[b, 0]
+                for k in range(1, order):
+                    acc = acc * xi + coef_horner[b, k]
+
+                if acc < lb:
+                    acc = lb
+                elif acc > ub:
+                    acc = ub
+
+                out[i] = acc
+
+        return _predict_kernel
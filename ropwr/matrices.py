@@ -7,6 +7,9 @@ Auxiliary functions to create model matrices.
 
 import numpy as np
 
+from scipy.sparse import csr_matrix
+from scipy.sparse import diags
+
 
 def matrix_A(x, splits, order):
     n = len(x)
@@ -31,6 +34,26 @@ def matrix_A(x, splits, order):
     return A
 
 
+def sparse_matrix_A(x, splits, order):
+    # Same as matrix_A without requiring sorted x. Each row stores the powers
+    # of x in the block of its bin, i.e., order nonzeros per row.
+    n = len(x)
+    n_bins = len(splits) + 1
+
+    indices = np.searchsorted(splits, x, side='right')
+
+    data = np.empty((n, order))
+    data[:, 0] = 1
+    for j in range(1, order):
+        data[:, j] = data[:, j - 1] * x
+
+    cols = indices[:, None] * order + np.arange(order)
+    indptr = np.arange(0, (n + 1) * order, order)
+
+    return csr_matrix((data.ravel(), cols.ravel(), indptr),
+                      shape=(n, n_bins * order))
+
+
 def matrix_S(x, splits, order):
     n_splits = len(splits)
     n_bins = n_splits + 1
@@ -50,17 +73,14 @@ def matrix_D(x, splits, order):
     n_splits = len(splits)
     n_bins = n_splits + 1
 
+    # Banded matrices are stored in sparse format
     if order == 1:
-        D = np.zeros((n_splits, n_bins))
-
-        for i in range(n_splits):
-            D[i, [i, i + 1]] = [-1, 1]
+        D = diags([-1, 1], [0, 1], shape=(n_splits, n_bins), format='csr')
 
     elif order == 2:
-        D = np.zeros((n_bins * order, n_bins * order))
-
-        for i in range(n_bins):
-            D[i, i * 2 + 1] = 1
+        rows = np.arange(n_bins)
+        D = csr_matrix((np.ones(n_bins), (rows, rows * 2 + 1)),
+                       shape=(n_bins * order, n_bins * order))
 
     return D
 
@@ -98,10 +118,11 @@ def matrix_H(x, splits, order):
     n_bins = n_splits + 1
 
     if order == 2 and n_bins > 1:
-        H = np.zeros((n_splits, n_bins * 2))
-
-        for i in range(n_splits):
-            H[i, [i * 2 + 1, i * 2 + 3]] = [-1, 1]
+        # Banded matrix stored in sparse format
+        rows = np.repeat(np.arange(n_splits), 2)
+        cols = 2 * rows + np.tile([1, 3], n_splits)
+        data = np.tile([-1., 1.], n_splits)
+        H = csr_matrix((data, (rows, cols)), shape=(n_splits, n_bins * 2))
     else:
         n = len(x)
         indices = np.searchsorted(splits, x, side='right')
@@ -49,9 +49,15 @@ class PyTest(TestCommand):
 install_requires = [
     'cvxpy>=1.0',
     'numpy>=1.16',
+    'scipy>=1.1',
     'scikit-learn>=0.22',
 ]
 
+# optional requirements
+extras_require = {
+    'numba': ['numba'],
+}
+
 # test requirements
 tests_require = [
     'pytest',
@@ -74,6 +80,7 @@ setup(
     cmdclass={'clean': CleanCommand, 'test': PyTest},
     python_requires='>=3.7',
     install_requires=install_requires,
+    extras_require=extras_require,
     tests_require=tests_require,
     classifiers=[
         'Topic :: Scientific/Engineering :: Mathematics',
@@ -5,12 +5,17 @@ RobustPWRegression testing.
 # Guillermo Navas-Palencia <g.navas.palencia@gmail.com>
 # Copyright (C) 2020
 
+import copy
+import pickle
+
 import numpy as np
+import ropwr.base
 
-from pytest import approx, raises
+from pytest import approx, fixture, raises, skip
 
 from ropwr import RobustPWRegression
 from ropwr.base import _choose_method
+from ropwr.kernels import NUMBA_AVAILABLE
 from sklearn.datasets import load_boston
 from sklearn.exceptions import NotFittedError
 
@@ -19,6 +24,15 @@ X, y = load_boston(return_X_y=True)
 x = X[:, -1]
 
 
+@fixture(params=[False, True], ids=["numpy", "numba"])
+def predict_path(request, monkeypatch):
+    # Run predict tests with both the NumPy and the Numba implementations
+    if request.param and not NUMBA_AVAILABLE:
+        skip("numba is not installed.")
+
+    monkeypatch.setattr(ropwr.base, "NUMBA_AVAILABLE", request.param)
+
+
 def test_params():
     with raises(ValueError):
         pw = RobustPWRegression(objective="l0")
@@ -68,6 +82,36 @@ def test_params():
         pw = RobustPWRegression(verbose=1)
         pw.fit(x, y, splits=[5, 10, 15])
 
+    with raises(ValueError):
+        pw = RobustPWRegression(dtype="float16")
+        pw.fit(x, y, splits=[5, 10, 15])
+
+    with raises(ValueError):
+        pw = RobustPWRegression(dtype="float16")
+        pw.fit_predict(x, y, splits=[5, 10, 15])
+
+    with raises(ValueError):
+        pw = RobustPWRegression(n_jobs=0)
+        pw.fit(x, y, splits=[5, 10, 15])
+
+
+def test_params_refit():
+    pw = RobustPWRegression()
+    pw.fit(x, y, splits=[5, 10, 15])
+
+    with raises(ValueError):
+        pw.set_params(degree=7)
+        pw.fit(x, y, splits=[5, 10, 15])
+
+    with raises(TypeError):
+        pw.set_params(degree=1, continuous=1)
+        pw.fit(x, y, splits=[5, 10, 15])
+
+    with raises(ValueError):
+        pw.set_params(continuous=True)
+        pw.fit(x, y, splits=[5, 10, 15], lb=5, ub=50)
+        pw.fit(x, y, splits=[5, 10, 15], lb=50, ub=5)
+
 
 def test_splits():
     with raises(TypeError):
@@ -83,6 +127,43 @@ def test_splits():
         pw.fit(x, y, splits=[5, 5, 10])
 
 
+def test_input(predict_path):
+    x_nan = x.copy()
+    x_nan[0] = np.nan
+
+    with raises(ValueError):
+        pw = RobustPWRegression()
+        pw.fit(x_nan, y, splits=[5, 10, 15])
+
+    with raises(ValueError):
+        pw = RobustPWRegression()
+        pw.fit(list(x_nan), y, splits=[5, 10, 15])
+
+    with raises(ValueError):
+        pw = RobustPWRegression()
+        pw.fit(x[:-1], y, splits=[5, 10, 15])
+
+    for solver in ("direct", "ecos"):
+        with raises(ValueError):
+            pw = RobustPWRegression(solver=solver)
+            pw.fit(np.array([]), np.array([]), splits=[1.])
+
+    pw = RobustPWRegression()
+    pw.fit(x, y, splits=[5, 10, 15])
+
+    with raises(ValueError):
+        pw.predict(x_nan)
+
+    with raises(ValueError):
+        pw.predict(x[:, None])
+
+    with raises(ValueError):
+        pw.fit(x[:, None], y, splits=[5, 10, 15])
+
+    pred = pw.predict(np.array([1e308, 1e308]))
+    assert pred.shape == (2,)
+
+
 def test_bounds():
     with raises(TypeError):
         pw = RobustPWRegression()
@@ -127,6 +208,21 @@ def test_discontinuous_default():
     assert pw_d.coef_ == approx(pw_e.coef_, rel=1e-6)
 
 
+def test_discontinuous_n_jobs():
+    splits = [5, 10, 15, 20]
+
+    for solver in ("direct", "osqp", "ecos"):
+        pw = RobustPWRegression(solver=solver, continuous=False)
+        pw.fit(x, y, splits)
+
+        pw_p = RobustPWRegression(solver=solver, continuous=False, n_jobs=2)
+        pw_p.fit(x, y, splits)
+
+        assert pw_p.coef_ == approx(pw.coef_, rel=1e-6)
+        assert pw_p.status == pw.status
+        assert pw_p.stats == pw.stats
+
+
 def test_solver_auto():
     pass
 
@@ -274,6 +370,43 @@ def test_solver_ecos_regularization():
     assert np.linalg.norm(pwrl2.coef_, 1) < np.linalg.norm(pw.coef_, 1)
 
 
+def test_fit_sorted():
+    splits = [5, 10, 15, 20]
+    x = X[:, -1]
+    idx = np.argsort(x)
+
+    pw = RobustPWRegression()
+    pw.fit(x, y, splits)
+
+    pw_s = RobustPWRegression()
+    pw_s.fit(x[idx], y[idx], splits)
+
+    assert pw.coef_ == approx(pw_s.coef_, rel=1e-8)
+
+    # Refit on the same array after modifying it in place
+    x_mod = x.copy()
+    pw.fit(x_mod, y, splits)
+    x_mod[:] = x_mod[::-1]
+    pw.fit(x_mod, y[::-1], splits)
+
+    assert pw.coef_ == approx(pw_s.coef_, rel=1e-8)
+
+
+def test_pickle():
+    splits = [5, 10, 15, 20]
+
+    pw = RobustPWRegression()
+    pw.fit(x, y, splits)
+
+    pw_p = pickle.loads(pickle.dumps(pw))
+    assert pw_p._sort_cache == (None, None)
+    assert pw._sort_cache[1] is not None
+    assert pw_p.predict(x) == approx(pw.predict(x), rel=1e-10)
+
+    pw_c = copy.deepcopy(pw)
+    assert pw_c._sort_cache == (None, None)
+
+
 def test_predict_not_fitted():
     pw = RobustPWRegression()
 
@@ -281,7 +414,7 @@ def test_predict_not_fitted():
         pw.predict(x)
 
 
-def test_fit_predict():
+def test_fit_predict(predict_path):
     splits = [5, 10, 15, 20]
     x = X[:, -1]
 
@@ -293,8 +426,112 @@ def test_fit_predict():
 
     assert pred1 == approx(pred2, rel=1e-8)
 
+    pred1 = pw.fit_predict(list(x), y, splits, lb=5, ub=50)
+    pred2 = pw.predict(x, lb=5, ub=50)
+
+    assert pred1 == approx(pred2, rel=1e-8)
+
+
+def test_predict_polyval(predict_path):
+    splits = [5, 10, 15, 20]
+    x = X[:, -1]
+
+    for degree in (0, 1, 2, 3):
+        pw = RobustPWRegression(degree=degree)
+        pw.fit(x, y, splits)
+        pred = pw.predict(x)
+
+        indices = np.searchsorted(splits, x, side='right')
+        pred_ref = np.zeros(x.shape)
+        for i in range(len(splits) + 1):
+            mask = (indices == i)
+            pred_ref[mask] = np.polyval(pw.coef_[i, ::-1], x[mask])
+
+        assert pred == approx(pred_ref, rel=1e-10)
+
+
+def test_predict_special_cases(predict_path):
+    x = X[:, -1]
+
+    pw = RobustPWRegression(degree=2)
+    pw.fit(x, y, splits=[])
+    pred = pw.predict(x)
+    assert pred == approx(np.polyval(pw.coef_[0, ::-1], x), rel=1e-10)
+
+    splits = [5, 10, 15, 20]
+    pw = RobustPWRegression(degree=0)
+    pw.fit(x, y, splits)
+    pred = pw.predict(x)
+    indices = np.searchsorted(splits, x, side='right')
+    assert pred == approx(pw.coef_[indices, 0], rel=1e-10)
+
+
+def test_predict_many_splits(predict_path):
+    x = X[:, -1]
+    splits = np.linspace(x.min(), x.max(), 30)[1:-1]
+
+    pw = RobustPWRegression(continuous=False)
+    pw.fit(x, y, splits)
+    pred = pw.predict(x)
+
+    indices = np.searchsorted(splits, x, side='right')
+    pred_ref = pw.coef_[indices, 0] + pw.coef_[indices, 1] * x
+
+    assert pred == approx(pred_ref, rel=1e-10)
+
+
+def test_predict_dtype(predict_path):
+    splits = [5, 10, 15, 20]
+    x = X[:, -1]
+    x32 = x.astype(np.float32)
+
+    pw = RobustPWRegression(degree=2)
+    pw.fit(x, y, splits)
+    pred = pw.predict(x)
+
+    pred32 = pw.predict(x32, lb=5, ub=50)
+    assert pred32.dtype == np.float32
+    assert pred32 == approx(np.clip(pred, 5, 50), rel=1e-4)
+
+    pw.set_params(dtype="float64")
+    assert pw.predict(x32).dtype == np.float64
+
+    pw.set_params(dtype="float32")
+    assert pw.predict(x).dtype == np.float32
+    assert pw.fit_predict(x, y, splits).dtype == np.float32
+
+    pw.set_params(dtype="auto")
+    assert pw.fit_predict(x32, y, splits).dtype == np.float32
+    assert pw.fit_predict(x, y, splits).dtype == np.float64
+
+    for dtype in ("bogus", "float16"):
+        with raises(ValueError):
+            pw.set_params(dtype=dtype)
+            pw.predict(x)
+
 
-def test_predict_bounds():
+def test_basis_matrix():
+    splits = [5, 10, 15, 20]
+    x = X[:, -1]
+
+    pw = RobustPWRegression(degree=2)
+
+    with raises(NotFittedError):
+        pw.basis_matrix(x)
+
+    pw.fit(x, y, splits)
+    B = pw.basis_matrix(x)
+
+    assert B.shape == (len(x), 15)
+    assert B @ pw.coef_.ravel() == approx(pw.predict(x), rel=1e-10)
+
+    # Use fitted coefficients if degree changes without refitting
+    pw.set_params(degree=1)
+    B = pw.basis_matrix(x)
+    assert B @ pw.coef_.ravel() == approx(pw.predict(x), rel=1e-10)
+
+
+def test_predict_bounds(predict_path):
     splits = [5, 10, 15, 20]
     x = X[:, -1]
 
@@ -312,6 +549,13 @@ def test_status():
     assert pw.status == "optimal"
 
 
+def test_status_separated():
+    pw = RobustPWRegression(degree=0, continuous=False)
+    pw.fit(x, y, splits=[5, 10, 15, 20])
+
+    assert pw.status == ["optimal"] * 5
+
+
 def test_stats():
     pw = RobustPWRegression()
     pw.fit(x, y, splits=[5, 10, 15, 20])